@@ -2,6 +2,7 @@ import numpy as np
 import pandas as pd
 import pickle
 import os
+import time
 import LightMap
 
 #####################################################################################
@@ -9,6 +10,8 @@ import LightMap
 #####################################################################################
 def ComputeObservedLight( dfsim ):
 
+    start_time = time.time()
+
     # get environment variable with path to TPC and true lightmap
     sim_dir = os.getenv('SIM_DIR')
     
@@ -27,17 +30,19 @@ def ComputeObservedLight( dfsim ):
     corrected_photoelectrons = detected_photoelectrons / \
                                lm_true.do_call(dfsim['fGenX'], dfsim['fGenY'], dfsim['fGenZ'])
 
-    event_radius = []
-    for index,row in dfsim.iterrows():
-        x = row['fXpos']
-        y = row['fYpos']
-        z = row['fZpos']
-        event_radius.append(np.sqrt(np.amax([[(x[i]-x[j])**2+(y[i]-y[j])**2+(z[i]-z[j])**2 for i in range(len(x))] for j in range(len(x))])))
+    # event size is the largest separation between any two deposits
+    event_radius = np.empty(len(dfsim))
+    for i,(x,y,z) in enumerate(dfsim[['fXpos','fYpos','fZpos']].itertuples(index=False)):
+        # report progress every 2**17 events
+        if i > 0 and (i & 0x1FFFF) == 0: print('Event {} at {:4.4}s...'.format(i,time.time()-start_time))
+        pos = np.stack((x,y,z))
+        sep = pos[:,:,np.newaxis] - pos[:,np.newaxis,:]
+        event_radius[i] = np.sqrt(np.amax(np.sum(sep**2,axis=0)))
 
     output_dict['Corrected Light'] = np.array(corrected_photoelectrons)
     output_dict['Observed Light'] = np.array(detected_photoelectrons)
     output_dict['fInitNOP'] = np.array(dfsim['fInitNOP'])
-    output_dict['event_radius'] = np.array(event_radius)
+    output_dict['event_radius'] = event_radius
     
     return output_dict
 
@@ -50,210 +55,185 @@ def ComputeObservedCharge( dfelec, pads_flag=False, channel_threshold=-100000 ):
     output_dict = dict()
 
     single_channel_charge_noise = 600. # electrons
-    
-    num_channels_nonzero_charge_with_noise = []
-    num_channels_nonzero_charge_excluding_noise = []
-    num_channels_in_evt = []
-    num_channels_excluding_noise = []
-    num_channels_collection = []
-    num_collection_below_threshold = []
-    num_channels_induction = []
-    evt_charge_two_strip_cut = []
-    evt_charge_five_strip_cut = []
-    evt_charge_six_strip_cut = []
-    evt_charge_eight_strip_cut = []
-    evt_charge_excluding_noise = []
-    evt_charge_including_noise = []
-    evt_charge_above_threshold = []
-    num_channels_above_threshold = []
-    
-    weighted_radius = []
-    weighted_drift = []
-    weighted_x = []
-    weighted_y = []
-    weighted_x_rms = []
-    weighted_y_rms = []   
- 
-    counter = 0
 
     #print(dfelec.head())
 
-    for index,row in dfelec.iterrows():
-        
-        counter += 1
-        if counter % 100000 == 0: print('Event {} at {:4.4}s...'.format(counter,time.time()-start_time))
-        
-        
-        is_noise_channel = []
-        drift_times = []
-        x_positions = []
-        y_positions = []
-        x_weights = []
-        y_weights = []
-        channel_charges = []
-        is_x_channel = []
-        
-        nch = len(row['fElecChannels.fChannelCharge'])
-        num_channels_in_evt.append( nch )
-    
-        if nch == 0:
-           evt_charge_two_strip_cut.append(0.)
-           evt_charge_five_strip_cut.append(0.)
-           evt_charge_six_strip_cut.append(0.)
-           evt_charge_eight_strip_cut.append(0.)
-           evt_charge_including_noise.append(0.)
-           evt_charge_excluding_noise.append(0.)
-           evt_charge_above_threshold.append(0.)
-           num_channels_above_threshold.append(0)
-           num_channels_excluding_noise.append(0)
-           num_channels_collection.append(0)
-           num_collection_below_threshold.append(0)
-           num_channels_induction.append(0)
-           weighted_radius.append(0.)
-           weighted_drift.append(0.)
-           weighted_x.append(0.)
-           weighted_y.append(0.)
-           weighted_x_rms.append(0.)
-           weighted_y_rms.append(0.)
-           num_channels_nonzero_charge_with_noise.append(0)
-           num_channels_nonzero_charge_excluding_noise.append(0)
-           continue 
-
-        for i in range(nch):
-            
-            # Local ID's greater than 15 correspond to Y-channels,
-            # otherwise they're x-channels
-            if pads_flag:
-                strip_width = 12.
-                strip_height = 12.
-                xoffset = 0.
-                yoffset = 0.
-            else:
-                if row['fElecChannels.fChannelLocalId'][i] > 15:
-                    strip_width = 96.
-                    strip_height = 6.
-                    xoffset = -96./2.
-                    yoffset = 0.
-                else:
-                    strip_width = 6.
-                    strip_height = 96.
-                    xoffset = 0.
-                    yoffset = -96./2.
-            
-            if np.array(row['fElecChannels.fChannelNoiseTag'][i]):
-                is_noise_channel.append(True)
-            else:
-                is_noise_channel.append(False)
-                drift_times.append( row['fElecChannels.fChannelTime'][i] \
-                                    + np.random.normal(0.,2.) )
-                x_positions.append( row['fElecChannels.fXPosition'][i] + xoffset )
-                y_positions.append( row['fElecChannels.fYPosition'][i] + yoffset )
-                x_weights.append(1./strip_width)
-                y_weights.append(1./strip_height)
-                channel_charges.append( row['fElecChannels.fChannelCharge'][i] )
-                if row['fElecChannels.fChannelLocalId'][i] > 15:
-                    is_x_channel.append(False)
-                else: 
-                    is_x_channel.append(True)
-
-        is_noise_channel = np.array(is_noise_channel) 
-        is_x_channel = np.array(is_x_channel)
-        drift_times = np.array(drift_times)
-        x_positions = np.array(x_positions)
-        y_positions = np.array(y_positions)
-        channel_charges = np.array(channel_charges)
-        x_weights = np.array(x_weights)
-        y_weights = np.array(y_weights)
-        
-        this_weighted_x = np.sum(x_positions*(channel_charges*x_weights))/np.sum(channel_charges*x_weights)
-        this_weighted_y = np.sum(y_positions*(channel_charges*y_weights))/np.sum(channel_charges*y_weights)
-       
-        this_weighted_x_rms = np.sqrt( np.sum( (x_positions - this_weighted_x)**2 * (channel_charges*x_weights) ) / \
-                                       np.sum(channel_charges*x_weights) )
-        this_weighted_y_rms = np.sqrt( np.sum( (y_positions - this_weighted_y)**2 * (channel_charges*y_weights) ) / \
-                                       np.sum(channel_charges*y_weights) )
- 
-        weighted_radius.append( np.sqrt(this_weighted_x**2 + this_weighted_y**2) )
-        weighted_drift.append(\
-                             np.sum(drift_times*channel_charges)/np.sum(channel_charges)
-                             )
-        weighted_x.append(this_weighted_x)
-        weighted_y.append(this_weighted_y)        
-
-        weighted_x_rms.append(this_weighted_x_rms)
-        weighted_y_rms.append(this_weighted_y_rms)
-
-        xmask_2strips = (is_x_channel)&(x_positions > this_weighted_x-13.)&(x_positions < this_weighted_x+13.)
-        ymask_2strips = (np.invert(is_x_channel))&(y_positions > this_weighted_y-13.)&(y_positions < this_weighted_y+13.)
-
-        xmask_5strips = (is_x_channel)&(x_positions > this_weighted_x-31.)&(x_positions < this_weighted_x+31.)
-        ymask_5strips = (np.invert(is_x_channel))&(y_positions > this_weighted_y-31.)&(y_positions < this_weighted_y+31.)
-
-        xmask_6strips = (is_x_channel)&(x_positions > this_weighted_x-37.)&(x_positions < this_weighted_x+37.)
-        ymask_6strips = (np.invert(is_x_channel))&(y_positions > this_weighted_y-37.)&(y_positions < this_weighted_y+37.)
-        
-        xmask_8strips = (is_x_channel)&(x_positions > this_weighted_x-49.)&(x_positions < this_weighted_x+49.)
-        ymask_8strips = (np.invert(is_x_channel))&(y_positions > this_weighted_y-49.)&(y_positions < this_weighted_y+49.)
-
-        nonzero_mask = np.invert(row['fElecChannels.fChannelCharge']==0) # true if collection
-        not_noise = np.invert(is_noise_channel)
-
-        fluctuated_charge = np.random.normal(0.,single_channel_charge_noise,size=nch)\
-                            + row['fElecChannels.fChannelCharge']
-        threshold_mask = fluctuated_charge>channel_threshold
-
-        num_channels_nonzero_charge_with_noise.append( np.sum(nonzero_mask) )
-        num_channels_nonzero_charge_excluding_noise.append( \
-                                                np.sum( nonzero_mask & not_noise )\
-                                                          )
-        
-
-        evt_charge_two_strip_cut.append( np.sum(row['fElecChannels.fChannelCharge'][not_noise][xmask_2strips]) + \
-                                         np.sum(row['fElecChannels.fChannelCharge'][not_noise][ymask_2strips]) + \
-                                         np.random.normal(0.,single_channel_charge_noise)*np.sqrt(8) )
-        evt_charge_five_strip_cut.append( np.sum(row['fElecChannels.fChannelCharge'][not_noise][xmask_5strips]) + \
-                                         np.sum(row['fElecChannels.fChannelCharge'][not_noise][ymask_5strips]) + \
-                                         np.random.normal(0.,single_channel_charge_noise)*np.sqrt(20) )
-        evt_charge_six_strip_cut.append( np.sum(row['fElecChannels.fChannelCharge'][not_noise][xmask_6strips]) + \
-                                         np.sum(row['fElecChannels.fChannelCharge'][not_noise][ymask_6strips]) + \
-                                         np.random.normal(0.,single_channel_charge_noise)*np.sqrt(24) )
-        evt_charge_eight_strip_cut.append( np.sum(row['fElecChannels.fChannelCharge'][not_noise][xmask_8strips]) + \
-                                           np.sum(row['fElecChannels.fChannelCharge'][not_noise][ymask_8strips]) + \
-                                           np.random.normal(0.,single_channel_charge_noise)*np.sqrt(32) )
-
-        evt_charge_including_noise.append(   np.sum(row['fElecChannels.fChannelCharge'][nonzero_mask]) )
-        evt_charge_excluding_noise.append(   np.sum(row['fElecChannels.fChannelCharge'][nonzero_mask & not_noise]) )
-        evt_charge_above_threshold.append(   np.sum( fluctuated_charge[ threshold_mask & not_noise ] ) )
-        num_channels_above_threshold.append( np.sum( threshold_mask & not_noise ))
-        num_channels_excluding_noise.append( np.sum( not_noise ) )
-        num_channels_collection.append(      np.sum( not_noise & nonzero_mask ) )
-        num_collection_below_threshold.append( np.sum( not_noise & nonzero_mask & np.invert(threshold_mask) ) )
-        num_channels_induction.append(       np.sum( not_noise & np.invert(nonzero_mask) ) )                          
-
-    output_dict['num_channels_in_evt'] = np.array(num_channels_in_evt)
-    output_dict['evt_charge_two_strip_cut'] = np.array(evt_charge_two_strip_cut)
-    output_dict['evt_charge_five_strip_cut'] = np.array(evt_charge_five_strip_cut)
-    output_dict['evt_charge_six_strip_cut'] = np.array(evt_charge_six_strip_cut)
-    output_dict['evt_charge_eight_strip_cut'] = np.array(evt_charge_eight_strip_cut)
-    output_dict['evt_charge_including_noise'] = np.array(evt_charge_including_noise)
-    output_dict['evt_charge_excluding_noise'] = np.array(evt_charge_excluding_noise)
-    output_dict['evt_charge_above_threshold'] = np.array(evt_charge_above_threshold)
-    output_dict['num_channels_above_threshold'] = np.array(num_channels_above_threshold)
-    output_dict['num_channels_excluding_noise'] = np.array(num_channels_excluding_noise)
-    output_dict['num_channels_collection'] = np.array(num_channels_collection)
-    output_dict['num_collection_below_threshold'] = np.array(num_collection_below_threshold)
-    output_dict['num_channels_induction'] = np.array(num_channels_induction)
-    output_dict['weighted_radius'] = np.array(weighted_radius)
-    output_dict['weighted_drift'] = np.array(weighted_drift)
-    output_dict['weighted_x'] = np.array(weighted_x)
-    output_dict['weighted_y'] = np.array(weighted_y) 
-    output_dict['weighted_x_rms'] = np.array(weighted_x_rms)
-    output_dict['weighted_y_rms'] = np.array(weighted_y_rms)
+    # flatten the per-event channel arrays into a single table of channels,
+    # keeping track of the event each channel belongs to
+    nrows = len(dfelec)
+    num_channels_in_evt = dfelec['fElecChannels.fChannelCharge'].map(len).to_numpy(dtype=np.int64)
+    empty_evt = num_channels_in_evt == 0
+    event_id = np.repeat(np.arange(nrows), num_channels_in_evt)
+
+    # fix the dtype of each channel column once, so nothing downstream works
+    # on object arrays; per-channel values are kept in single precision and
+    # only the per-event sums are accumulated in double precision
+    channel_charge = FlattenColumn( dfelec['fElecChannels.fChannelCharge'], np.float32 )
+    channel_localid = FlattenColumn( dfelec['fElecChannels.fChannelLocalId'], np.int16 )
+    is_noise_channel = FlattenColumn( dfelec['fElecChannels.fChannelNoiseTag'], bool )
+    channel_time = FlattenColumn( dfelec['fElecChannels.fChannelTime'], np.float32 )
+    channel_xpos = FlattenColumn( dfelec['fElecChannels.fXPosition'], np.float32 )
+    channel_ypos = FlattenColumn( dfelec['fElecChannels.fYPosition'], np.float32 )
+    total_channels = len(channel_charge)
+
+    # draw all of the electronics noise up front in a few vectorized calls
+    rng = np.random.default_rng()
+    drift_noise = rng.standard_normal(total_channels,dtype=np.float32)*np.float32(2.)
+    charge_noise = rng.standard_normal(total_channels,dtype=np.float32)*np.float32(single_channel_charge_noise)
+    summed_noise = rng.normal(0.,single_channel_charge_noise,size=(nrows,4))*np.invert(empty_evt)[:,np.newaxis]
+
+    not_noise = np.invert(is_noise_channel)
+
+    # Local ID's greater than 15 correspond to Y-channels,
+    # otherwise they're x-channels
+    is_y_channel = channel_localid > 15
+    if pads_flag:
+        strip_width = np.full(total_channels,12.,dtype=np.float32)
+        strip_height = np.full(total_channels,12.,dtype=np.float32)
+        xoffset = np.zeros(total_channels,dtype=np.float32)
+        yoffset = np.zeros(total_channels,dtype=np.float32)
+    else:
+        strip_width = np.where(is_y_channel,np.float32(96.),np.float32(6.))
+        strip_height = np.where(is_y_channel,np.float32(6.),np.float32(96.))
+        xoffset = np.where(is_y_channel,np.float32(-96./2.),np.float32(0.))
+        yoffset = np.where(is_y_channel,np.float32(0.),np.float32(-96./2.))
+
+    nonzero_mask = channel_charge != 0 # true if collection
+
+    fluctuated_charge = charge_noise + channel_charge
+    threshold_mask = fluctuated_charge>channel_threshold
+
+    # combined channel masks shared by the per-event counts and sums
+    collection_mask = not_noise & nonzero_mask
+    induction_mask = not_noise & np.invert(nonzero_mask)
+    above_threshold_mask = not_noise & threshold_mask
+    below_threshold_mask = collection_mask & np.invert(threshold_mask)
+
+    # all per-event channel counts and charge sums in one pass each
+    channel_counts = SumByEvent( np.column_stack((nonzero_mask, collection_mask, not_noise, \
+                                                  above_threshold_mask, below_threshold_mask, induction_mask)), \
+                                 num_channels_in_evt, dtype=np.int32 )
+    num_channels_nonzero_charge_with_noise = channel_counts[:,0]
+    num_channels_nonzero_charge_excluding_noise = channel_counts[:,1]
+    num_channels_collection = channel_counts[:,1]
+    num_channels_excluding_noise = channel_counts[:,2]
+    num_channels_above_threshold = channel_counts[:,3]
+    num_collection_below_threshold = channel_counts[:,4]
+    num_channels_induction = channel_counts[:,5]
+
+    channel_sums = SumByEvent( np.column_stack((channel_charge*nonzero_mask, channel_charge*collection_mask, \
+                                                fluctuated_charge*above_threshold_mask)), num_channels_in_evt )
+    evt_charge_including_noise = channel_sums[:,0]
+    evt_charge_excluding_noise = channel_sums[:,1]
+    evt_charge_above_threshold = channel_sums[:,2]
+
+    # position reconstruction only uses the channels not tagged as noise
+    signal_id = event_id[not_noise]
+    is_x_channel = np.invert(is_y_channel)[not_noise]
+    drift_times = (channel_time + drift_noise)[not_noise]
+    x_positions = (channel_xpos + xoffset)[not_noise]
+    y_positions = (channel_ypos + yoffset)[not_noise]
+    x_weights = np.float32(1.)/strip_width[not_noise]
+    y_weights = np.float32(1.)/strip_height[not_noise]
+    channel_charges = channel_charge[not_noise]
+
+    # combined charge and strip-size weights
+    x_charge_weights = channel_charges*x_weights
+    y_charge_weights = channel_charges*y_weights
+
+    signal_sums = SumByEvent( np.column_stack((x_charge_weights, y_charge_weights, \
+                                               x_positions*x_charge_weights, y_positions*y_charge_weights, \
+                                               channel_charges, drift_times*channel_charges)), \
+                              num_channels_excluding_noise )
+    x_weight_sums = signal_sums[:,0]
+    y_weight_sums = signal_sums[:,1]
+
+    # events with no channels are reported as zero rather than NaN
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weighted_x = signal_sums[:,2]/x_weight_sums
+        weighted_y = signal_sums[:,3]/y_weight_sums
+        weighted_drift = signal_sums[:,5]/signal_sums[:,4]
+        weighted_x[empty_evt] = 0.
+        weighted_y[empty_evt] = 0.
+        weighted_drift[empty_evt] = 0.
+
+        rms_sums = SumByEvent( np.column_stack(((x_positions - weighted_x[signal_id])**2 * x_charge_weights, \
+                                                (y_positions - weighted_y[signal_id])**2 * y_charge_weights)), \
+                               num_channels_excluding_noise )
+        weighted_x_rms = np.sqrt( rms_sums[:,0]/x_weight_sums )
+        weighted_y_rms = np.sqrt( rms_sums[:,1]/y_weight_sums )
+        weighted_x_rms[empty_evt] = 0.
+        weighted_y_rms[empty_evt] = 0.
+
+    weighted_radius = np.sqrt(weighted_x**2 + weighted_y**2)
+
+    # charge within 2, 5, 6 and 8 strips of the weighted position, measured
+    # along x for x-channels and along y for y-channels
+    strip_cut_widths = np.array((13.,31.,37.,49.))
+    strip_cut_noise = np.sqrt((8.,20.,24.,32.))
+    distance_to_center = np.where(is_x_channel, np.abs(x_positions - weighted_x[signal_id]), \
+                                                np.abs(y_positions - weighted_y[signal_id]))
+    strip_cut_masks = distance_to_center[:,np.newaxis] < strip_cut_widths
+    strip_cut_sums = SumByEvent( channel_charges[:,np.newaxis]*strip_cut_masks, num_channels_excluding_noise ) \
+                     + summed_noise*strip_cut_noise
+    evt_charge_two_strip_cut = strip_cut_sums[:,0]
+    evt_charge_five_strip_cut = strip_cut_sums[:,1]
+    evt_charge_six_strip_cut = strip_cut_sums[:,2]
+    evt_charge_eight_strip_cut = strip_cut_sums[:,3]
+
+    output_dict['num_channels_in_evt'] = num_channels_in_evt
+    output_dict['evt_charge_two_strip_cut'] = evt_charge_two_strip_cut
+    output_dict['evt_charge_five_strip_cut'] = evt_charge_five_strip_cut
+    output_dict['evt_charge_six_strip_cut'] = evt_charge_six_strip_cut
+    output_dict['evt_charge_eight_strip_cut'] = evt_charge_eight_strip_cut
+    output_dict['evt_charge_including_noise'] = evt_charge_including_noise
+    output_dict['evt_charge_excluding_noise'] = evt_charge_excluding_noise
+    output_dict['evt_charge_above_threshold'] = evt_charge_above_threshold
+    output_dict['num_channels_above_threshold'] = num_channels_above_threshold
+    output_dict['num_channels_excluding_noise'] = num_channels_excluding_noise
+    output_dict['num_channels_collection'] = num_channels_collection
+    output_dict['num_collection_below_threshold'] = num_collection_below_threshold
+    output_dict['num_channels_induction'] = num_channels_induction
+    output_dict['weighted_radius'] = weighted_radius
+    output_dict['weighted_drift'] = weighted_drift
+    output_dict['weighted_x'] = weighted_x
+    output_dict['weighted_y'] = weighted_y 
+    output_dict['weighted_x_rms'] = weighted_x_rms
+    output_dict['weighted_y_rms'] = weighted_y_rms
 
     output_dict['num_channels_nonzero_charge_with_noise'] = \
-                    np.array(num_channels_nonzero_charge_with_noise)
+                    num_channels_nonzero_charge_with_noise
     output_dict['num_channels_nonzero_charge_excluding_noise'] = \
-                    np.array(num_channels_nonzero_charge_excluding_noise)
+                    num_channels_nonzero_charge_excluding_noise
     output_dict['fNTE'] = np.array(dfelec['fNTE'])
     
     return output_dict
+
+
+#####################################################################################
+# FLATTEN A COLUMN OF PER-EVENT CHANNEL ARRAYS
+#####################################################################################
+def FlattenColumn( column, dtype ):
+
+    # concatenate the per-event arrays into one array of the given dtype;
+    # np.concatenate needs at least one array, so handle an empty column here
+    if len(column) == 0:
+        return np.zeros(0, dtype=dtype)
+
+    return np.concatenate(column.values).astype(dtype,copy=False)
+
+
+#####################################################################################
+# SUM PER-CHANNEL QUANTITIES OVER EACH EVENT
+#####################################################################################
+def SumByEvent( values, nch, dtype=np.float64 ):
+
+    # values holds one row per channel, with the channels of each event stored
+    # contiguously; sum every column over each event in a single pass
+    sums = np.zeros((len(nch),)+values.shape[1:], dtype=dtype)
+    has_channels = nch > 0
+    if np.any(has_channels):
+        starts = np.cumsum(nch) - nch
+        sums[has_channels] = np.add.reduceat(values, starts[has_channels], axis=0, dtype=dtype)
+
+    return sums
@@ -9,7 +9,12 @@ import os
 import pickle
 import argparse
 import time
-import gzip
+from concurrent.futures import ThreadPoolExecutor
+# ISA-L's gzip is a drop-in replacement that decompresses the input files much faster
+try:
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
 from plot_data import plot_lm_rz,proj2d,make_figs,plot_results
 
 # ***********************************************************************************************************
@@ -92,6 +97,11 @@ def peak_sep(x):
 def cl_cut(x,y):
     return y>100
 
+# load one processed simulation file
+def load_file(data_file):
+    with gzip.open(data_file,'rb') as input_file:
+        return pickle.load(input_file)
+
 # set plotting style
 plt.rc('figure', dpi=200, figsize=(4,3), facecolor='w')
 plt.rc('savefig', dpi=200, facecolor='w')
@@ -130,14 +140,10 @@ fig.savefig(path+'original.png',bbox_inches='tight')
 # LOOP THROUGH ALL DATASETS
 # *********************************************************************************************************
 
-# loop through and collect the specified number of events
-data = []
+# read and decompress the files on several threads at once
 print('Collecting events from {:d} processed simulation files...\n'.format(len(input_files)))
-for data_file in input_files:
-    input_file = gzip.open(data_file,'rb')
-    this_df = pickle.load(input_file)
-    data.append(this_df)
-    input_file.close()
+with ThreadPoolExecutor(max_workers=min(8,len(input_files))) as executor:
+    data = list(executor.map(load_file,input_files))
 
 # add to pandas dataframe
 data = pd.concat(data,ignore_index=True)
@@ -150,7 +156,9 @@ if validation:
     val_string = 'and {:d} events for validation '.format(events)
 
 print('Sampling {:d} events for calibration '.format(events)+val_string+'using seed {:d}...\n'.format(seed))
-data = data.sample(val_factor*events, random_state=seed)
+rng = np.random.default_rng(seed)
+sample_idx = rng.choice(len(data.index), size=val_factor*events, replace=False)
+data = data.iloc[sample_idx].reset_index(drop=True)
     
 # compute z from the drift time and TPC dimensions
 # drift velocity from 2021 sensitivity paper
@@ -168,19 +176,19 @@ print('Applying quality cuts to the data...\n')
 data_size = len(data.index)
 evt_size_cut = 5000000.
 cuts = data['event_radius']<evt_size_cut
-after_size = len(data[cuts].index)
+after_size = int(cuts.sum())
 
 # cut events with no charge signal
-cuts = cuts & ~(data['evt_charge_including_noise']==0)
-after_elec = len(data[cuts].index)
+cuts = cuts & (data['evt_charge_including_noise'].values!=0)
+after_elec = int(cuts.sum())
 
 # cut events with NaN z values
-cuts = cuts & ~(np.isnan(data['z']))
-after_drift = len(data[cuts].index)
+cuts = cuts & ~np.isnan(data.z.values)
+after_drift = int(cuts.sum())
 
 # cut events with no photons produced
-cuts = cuts & ~(data['Observed Light']==0)
-after_photon = len(data[cuts].index)
+cuts = cuts & (data['Observed Light'].values!=0)
+after_photon = int(cuts.sum())
 
 # apply fiducial cut
 zlim = [tpc.zmin+standoff,tpc.zmax-standoff]
@@ -188,20 +196,19 @@ rlim = [0,tpc.r-standoff]
 inside_z = abs(data.z.values-(zlim[1]-zlim[0])/2.-zlim[0])>(zlim[1]-zlim[0])/2.
 inside_r = abs(data.weighted_radius.values-(rlim[1]-rlim[0])/2.-rlim[0])>(rlim[1]-rlim[0])/2.
 cuts = cuts & (~inside_z & ~inside_r)
-after_fiducial = len(data[cuts].index)
+after_fiducial = int(cuts.sum())
 
 # sample based on number of photons generated
 qe = 0.186
 
 # separate low and high energy peaks
-data['peak'] = np.ones(len(data['Observed Light']))
-peak_cond = peak_sep(data.evt_charge_including_noise.values) < data['Observed Light']
-data.loc[peak_cond,'peak'] = 2
+peak_cond = peak_sep(data.evt_charge_including_noise.values) < data['Observed Light'].values
+data['peak'] = np.where(peak_cond,np.int8(2),np.int8(1))
 
 # cut out data that is not in one of the peaks
 cut_cond = cl_cut(data.evt_charge_including_noise.values,data['Observed Light'])
 cuts = cuts & cut_cond
-after_chargelight = len(data[cuts].index)
+after_chargelight = int(cuts.sum())
 
 # print information about size of events
 med_size = np.median(data['event_radius'][cuts])
@@ -225,16 +232,16 @@ print('Events after charge/light cut: '+str(after_chargelight))
 print('Charge/light cut efficiency: {:.1f} %\n'.format(after_chargelight*100./after_fiducial))
 
 # compute mean number of photons for each peak
-peaks = np.array((0,0))
-for j in range(2):
-    peaks[j] = np.mean(data['Observed Light'][(data['peak']==j+1) & cuts])
+peaks = data.loc[cuts,['peak','Observed Light']].groupby('peak',sort=True)['Observed Light'].mean()\
+            .reindex([1,2]).to_numpy(dtype=np.float64)
     
 # compute the efficiency using the predicted mean of each peak
 print('Computing the efficiency from the data selected...\n')
 mean_eff = np.mean(data['Observed Light'][(data.peak.values==2) & cuts]/data['fInitNOP'][(data.peak.values==2) & cuts])
-data['eff'] = data['Observed Light']*mean_eff/(qe*peaks[np.array(data.peak.values-1,dtype=int)])
+eff_denom = np.where(data.peak.values==2,peaks[1],peaks[0])*qe
+data['eff'] = data['Observed Light'].values*mean_eff/eff_denom
 
-np.savetxt(path+'effic_'+name+'.txt',np.array(data.eff.values))
+np.save(path+'effic_'+name+'.npy',data.eff.values.astype(np.float32))
 
 # *****************************************************************************************************
 # PLOT ALL DATA BEFORE TRAINING